@@ -0,0 +1,380 @@
+# Analyse du mesh seule (chargement, topologie, volume/aire/bornes), sans Flask,
+# boto3 ni redis : c'est tout ce que les processus du pool d'analyse importent.
+
+import os
+import io
+import threading
+from dataclasses import dataclass
+
+import numpy as np
+import trimesh
+
+try:
+    import numba
+    from numba import njit, prange
+except ImportError:
+    numba  = None
+    njit   = None
+    prange = range
+    print("numba non installé — intégration du mesh en NumPy pur")
+
+# Réparation des orientations (fix_normals) avant calcul : coûteuse et rarement
+# utile pour un devis, désactivée sauf TFB_REPAIR_MESH=1
+REPARER_MESH = os.environ.get("TFB_REPAIR_MESH", "0") == "1"
+
+# ===================== CHARGEMENT MESH =====================
+
+# Balises 3MF sous leur forme étendue "{namespace}tag", comparées telles quelles
+# à elem.tag (pas de préfixe "m:" à résoudre à chaque élément)
+NS_3MF       = "{http://schemas.microsoft.com/3dmanufacturing/core/2015/02}"
+NS_MESH      = NS_3MF + "mesh"
+NS_VERTICES  = NS_3MF + "vertices"
+NS_TRIANGLES = NS_3MF + "triangles"
+NS_VERTEX    = NS_3MF + "vertex"
+NS_TRIANGLE  = NS_3MF + "triangle"
+
+def load_mesh_3mf(file_bytes):
+    """
+    Parse un .3mf manuellement (ZIP + XML), sans le loader 3MF de trimesh.
+    Secours de load_mesh si ce loader échoue (ne tient pas compte des
+    transformations du <build>).
+    Le XML est lu en flux (iterparse) : chaque <vertex>/<triangle> est vidé dès
+    qu'il est lu, la mémoire ne dépend pas de la taille du .model.
+    Retourne un trimesh.Trimesh construit depuis les vertices/faces extraits.
+    """
+    import zipfile
+    import xml.etree.ElementTree as ET
+    from array import array
+
+    # Buffers C à croissance amortie, vus sans copie en NumPy à la fin.
+    # Indices en int32 : buffer de parsing deux fois plus petit (trimesh les
+    # repasse de toute façon en int64 dans Trimesh.faces).
+    coords  = array("d")
+    indices = array("i")
+
+    with zipfile.ZipFile(io.BytesIO(file_bytes), "r") as zf:
+        # Cherche tous les fichiers .model dans le ZIP
+        model_files = [n for n in zf.namelist() if n.endswith(".model")]
+        if not model_files:
+            raise ValueError("Aucun fichier .model trouvé dans le .3mf")
+
+        for model_file in model_files:
+            with zf.open(model_file) as stream:
+                vertex_offset = 0
+                conteneur     = None
+                for event, elem in ET.iterparse(stream, events=("start", "end")):
+                    tag = elem.tag
+                    if event == "start":
+                        if tag == NS_MESH:
+                            vertex_offset = len(coords) // 3
+                        elif tag == NS_VERTICES or tag == NS_TRIANGLES:
+                            conteneur = elem
+                    elif tag == NS_VERTEX:
+                        a = elem.attrib
+                        coords.extend((float(a["x"]), float(a["y"]), float(a["z"])))
+                        conteneur.clear()   # le parent ne garde pas les éléments lus
+                    elif tag == NS_TRIANGLE:
+                        a = elem.attrib
+                        indices.extend((
+                            int(a["v1"]) + vertex_offset,
+                            int(a["v2"]) + vertex_offset,
+                            int(a["v3"]) + vertex_offset,
+                        ))
+                        conteneur.clear()
+                    elif tag == NS_MESH:
+                        elem.clear()
+
+    if not coords or not indices:
+        raise ValueError("Aucune géométrie valide trouvée dans le .3mf")
+
+    return trimesh.Trimesh(
+        vertices=np.frombuffer(coords, dtype=np.float64).reshape(-1, 3),
+        faces=np.frombuffer(indices, dtype=np.int32).reshape(-1, 3),
+        process=False
+    )
+
+
+def load_mesh(file_bytes, suffix):
+    """
+    Charge STL, 3MF ou OBJ et retourne un trimesh.Trimesh unique.
+    - .3mf : loader trimesh (lxml + networkx), parser manuel en secours
+    - .stl / .obj : trimesh.load_mesh sans passer par la Scene, process=False
+    Pour STL/OBJ, seule la fusion des vertices est conservée : sans elle un STL
+    n'a aucune arête partagée et is_watertight serait toujours faux. Le 3MF est
+    déjà indexé (vertices partagés), il n'en a pas besoin.
+    """
+    if suffix == ".3mf":
+        try:
+            mesh = trimesh.load(io.BytesIO(file_bytes), file_type="3mf", force="mesh", process=False)
+            if not isinstance(mesh, trimesh.Trimesh) or len(mesh.faces) == 0:
+                raise ValueError("3MF sans géométrie exploitable")
+        except Exception as e:
+            print(f"Loader 3MF trimesh en échec ({e}) — parser manuel")
+            mesh = load_mesh_3mf(file_bytes)
+    else:
+        loaded = trimesh.load_mesh(io.BytesIO(file_bytes), file_type=suffix[1:], process=False)
+        if isinstance(loaded, trimesh.Trimesh):
+            mesh = loaded
+        elif isinstance(loaded, trimesh.Scene):
+            meshes = [g for g in loaded.geometry.values() if isinstance(g, trimesh.Trimesh)]
+            if not meshes:
+                raise ValueError("Aucune géométrie valide trouvée dans le fichier.")
+            mesh = trimesh.util.concatenate(meshes)
+        else:
+            raise ValueError(f"Format non reconnu : {type(loaded)}")
+        mesh.merge_vertices()
+
+    # Le volume est pris en valeur absolue : une orientation globale inversée
+    # ne pose pas problème. Seul un mélange d'orientations fausse l'intégrale,
+    # on ne répare donc que dans ce cas, et seulement si REPARER_MESH
+    # (fill_holes est trop coûteux ici).
+    if REPARER_MESH and not mesh.is_winding_consistent:
+        trimesh.repair.fix_normals(mesh)
+
+    return mesh
+
+# Enregistrement STL binaire : normale (12 o) + 3 sommets (36 o) + attribut (2 o)
+STL_DTYPE = np.dtype([("normale", "<f4", (3,)), ("sommets", "<f4", (3, 3)), ("attr", "<u2")])
+
+def sommets_stl_binaire(file_bytes):
+    """
+    Vue (F, 3, 3) float32 sur les sommets d'un STL binaire, directement dans le
+    buffer (aucune copie, aucun parsing). Retourne None si le fichier n'est pas
+    un STL binaire (ASCII, tronqué…) : le chargement trimesh s'en chargera.
+    """
+    if len(file_bytes) < 84:
+        return None
+    n_tri = int.from_bytes(file_bytes[80:84], "little")
+    if n_tri == 0 or len(file_bytes) != 84 + 50 * n_tri:
+        return None
+
+    return np.frombuffer(file_bytes, dtype=STL_DTYPE, count=n_tri, offset=84)["sommets"]
+
+# Triangles lus pour estimer l'encombrement d'un STL avant toute analyse
+ECHANTILLON_STL = 1024
+
+def bornes_stl(sommets):
+    """
+    (bmin, bmax) des triangles donnés. Vue (F, 9) réduite sur l'axe 0 puis 3×3 :
+    bien plus rapide que min/max(axis=(0, 1)) sur la vue à pas de 50 o.
+    """
+    plat = sommets.reshape(-1, 9)
+    return plat.min(axis=0).reshape(3, 3).min(axis=0), plat.max(axis=0).reshape(3, 3).max(axis=0)
+
+def etendue_stl(sommets):
+    """
+    Dimensions (x, y, z) des triangles donnés. Sur un échantillon
+    sommets[::pas], c'est un minorant des vraies dimensions.
+    """
+    bmin, bmax = bornes_stl(sommets)
+    return bmax - bmin
+
+def topologie_triangles(tris):
+    """
+    (watertight, orientation_coherente) d'une soupe de triangles (F, 3, 3) float32 :
+    les sommets aux coordonnées identiques sont soudés (tri lexicographique sur
+    leurs bits), puis chaque arête doit apparaître exactement deux fois, et
+    jamais deux fois dans le même sens si l'orientation est cohérente.
+    """
+    bits  = tris.reshape(-1, 3).view(np.uint32)
+    xy    = (bits[:, 0].astype(np.uint64) << np.uint64(32)) | bits[:, 1]
+    ordre = np.lexsort((bits[:, 2], xy))
+    xy_o, z_o = xy[ordre], bits[ordre, 2]
+
+    nouveau     = np.empty(len(ordre), dtype=bool)
+    nouveau[0]  = True
+    nouveau[1:] = (xy_o[1:] != xy_o[:-1]) | (z_o[1:] != z_o[:-1])
+    ids         = np.empty(len(ordre), dtype=np.int64)
+    ids[ordre]  = np.cumsum(nouveau) - 1
+    n_sommets   = int(ids.max()) + 1
+
+    faces = ids.reshape(-1, 3)
+    a, b  = faces.ravel(), faces[:, [1, 2, 0]].ravel()
+
+    aretes  = np.sort(np.minimum(a, b) * n_sommets + np.maximum(a, b))
+    etanche = (
+        len(aretes) % 2 == 0
+        and bool((aretes[0::2] == aretes[1::2]).all())
+        and not (aretes[2::2] == aretes[1:-1:2]).any()
+    )
+    diriges  = np.sort(a * n_sommets + b)
+    coherent = not (diriges[1:] == diriges[:-1]).any()
+    return etanche, coherent
+
+# ===================== MESURE =====================
+
+@dataclass(frozen=True, slots=True)
+class StatsMesh:
+    """Invariants du mesh à l'échelle 1 — tout ce dont le devis a besoin."""
+    volume_mm3: float
+    aire_mm2:   float
+    dims:       tuple
+    watertight: bool
+
+def _integrer_numpy(tris):
+    """
+    Volume (tétraèdres signés depuis l'origine), aire et bornes d'un tableau
+    (F, 3, 3) : le produit vectoriel sert au volume et à l'aire.
+    """
+    v0, v1, v2 = tris[:, 0], tris[:, 1], tris[:, 2]
+    cross  = np.cross(v1 - v0, v2 - v0)
+    carres = np.einsum("ij,ij->i", cross, cross)
+    aire   = 0.5 * np.sqrt(carres, out=carres).sum(dtype=np.float64)
+    volume = abs(np.einsum("ij,ij->i", v0, cross).sum(dtype=np.float64)) / 6.0
+    points = tris.reshape(-1, 3)
+    return volume, aire, points.min(axis=0), points.max(axis=0)
+
+def _integrer_boucle(tris):
+    """
+    Même calcul que _integrer_numpy, écrit triangle par triangle pour numba :
+    une seule lecture du tableau, aucun temporaire, réductions parallèles
+    (sommes pour volume/aire, min/max pour les bornes).
+    Bornes initialisées sur le premier sommet : fastmath suppose l'absence d'inf.
+    """
+    volume = 0.0
+    aire   = 0.0
+    xmin = xmax = tris[0, 0, 0]
+    ymin = ymax = tris[0, 0, 1]
+    zmin = zmax = tris[0, 0, 2]
+    for i in prange(tris.shape[0]):
+        ax, ay, az = tris[i, 0, 0], tris[i, 0, 1], tris[i, 0, 2]
+        bx, by, bz = tris[i, 1, 0], tris[i, 1, 1], tris[i, 1, 2]
+        qx, qy, qz = tris[i, 2, 0], tris[i, 2, 1], tris[i, 2, 2]
+        ux, uy, uz = bx - ax, by - ay, bz - az
+        vx, vy, vz = qx - ax, qy - ay, qz - az
+        cx = uy * vz - uz * vy
+        cy = uz * vx - ux * vz
+        cz = ux * vy - uy * vx
+        aire   += 0.5 * np.sqrt(cx * cx + cy * cy + cz * cz)
+        volume += ax * cx + ay * cy + az * cz
+        # Réductions prange : uniquement la forme binaire acc = min(acc, x)
+        xmin = min(xmin, min(ax, bx, qx))
+        ymin = min(ymin, min(ay, by, qy))
+        zmin = min(zmin, min(az, bz, qz))
+        xmax = max(xmax, max(ax, bx, qx))
+        ymax = max(ymax, max(ay, by, qy))
+        zmax = max(zmax, max(az, bz, qz))
+    return abs(volume) / 6.0, aire, (xmin, ymin, zmin), (xmax, ymax, zmax)
+
+if njit is not None:
+    _integrer_boucle = njit(parallel=True, fastmath=True, cache=True)(_integrer_boucle)
+
+# Le noyau occupe déjà tous les cœurs, et la couche de threads "workqueue" de
+# numba (celle des installations sans TBB/OpenMP) refuse les appels concurrents :
+# les threads du serveur passent donc un par un.
+_noyau_lock = threading.Lock()
+
+def integrer_triangles(tris):
+    """
+    Retourne (volume_mm3, aire_mm2, dims) en une passe sur les triangles ;
+    noyau numba si disponible, sinon NumPy.
+    """
+    if len(tris) == 0:
+        raise ValueError("Mesh sans aucun triangle")
+    if njit is not None:
+        with _noyau_lock:
+            volume, aire, bmin, bmax = _integrer_boucle(tris)
+    else:
+        volume, aire, bmin, bmax = _integrer_numpy(tris)
+    dims = tuple(float(hi) - float(lo) for lo, hi in zip(bmin, bmax))
+    return float(volume), float(aire), dims
+
+def mesurer_stl_binaire(sommets):
+    """
+    Même résultat que mesurer_mesh(load_mesh(...)) pour un STL binaire, sans
+    trimesh. Retourne None si l'orientation des faces est incohérente et que
+    REPARER_MESH est actif : ce cas demande fix_normals, donc le chargement complet.
+    """
+    # Copie contiguë recentrée (précision float32 loin de l'origine) ; "+= 0"
+    # ramène -0.0 à 0.0 pour que la soudure par bits ne les distingue pas.
+    # Le centre d'un échantillon suffit : les vraies bornes sortent du noyau.
+    bmin, bmax = bornes_stl(sommets[::max(1, len(sommets) // ECHANTILLON_STL)])
+    tris  = sommets - (bmin + bmax) / 2
+    tris += np.float32(0)
+
+    etanche, coherent = topologie_triangles(tris)
+    if REPARER_MESH and not coherent:
+        return None
+
+    return StatsMesh(*integrer_triangles(tris), etanche)
+
+def mesurer_mesh(mesh):
+    """
+    Extrait du mesh les seules grandeurs utiles au devis :
+    un StatsMesh de quelques floats, facile à cacher.
+    """
+    # Un seul gather vertices[faces] en (F, 3, 3) contigu, lu une seule fois par
+    # integrer_triangles pour le volume, l'aire et les bornes.
+    # float32 suffit largement au devis (~0.01 mm) et divise la bande passante
+    # par deux ; les vertices sont recentrés avant conversion pour garder toute
+    # la précision sur les pièces éloignées de l'origine. Les accumulations se
+    # font en float64.
+    verts = mesh.vertices
+    verts = (verts - verts.mean(axis=0)).astype(np.float32)
+    tris  = verts[mesh.faces]
+
+    return StatsMesh(*integrer_triangles(tris), bool(mesh.is_watertight))
+
+# ===================== PRÉCHAUFFAGE =====================
+# Le premier /analyze payait les chargements paresseux de trimesh (repair,
+# graphes d'adjacence, imports networkx/lxml du loader 3MF) et le chargement/
+# compilation du noyau numba. app.py fait passer un tétraèdre en STL binaire et
+# en 3MF par tout le pipeline au démarrage, là où l'analyse tourne : processus
+# web, ou chaque processus du pool.
+
+def _stl_binaire(sommets):
+    recs = np.zeros(len(sommets), dtype=STL_DTYPE)
+    recs["sommets"] = sommets
+    return bytes(80) + len(sommets).to_bytes(4, "little") + recs.tobytes()
+
+_TETRA_STL = _stl_binaire([
+    [[0, 0, 0], [0, 1, 0], [1, 0, 0]],
+    [[0, 0, 0], [1, 0, 0], [0, 0, 1]],
+    [[0, 0, 0], [0, 0, 1], [0, 1, 0]],
+    [[1, 0, 0], [0, 1, 0], [0, 0, 1]],
+])
+
+def _3mf_minimal():
+    import zipfile
+    model = (
+        '<?xml version="1.0" encoding="UTF-8"?>'
+        f'<model unit="millimeter" xmlns="{NS_3MF[1:-1]}"><resources><object id="1" type="model"><mesh>'
+        '<vertices><vertex x="0" y="0" z="0"/><vertex x="1" y="0" z="0"/>'
+        '<vertex x="0" y="1" z="0"/><vertex x="0" y="0" z="1"/></vertices>'
+        '<triangles><triangle v1="0" v2="2" v3="1"/><triangle v1="0" v2="1" v3="3"/>'
+        '<triangle v1="0" v2="3" v3="2"/><triangle v1="1" v2="2" v3="3"/></triangles>'
+        '</mesh></object></resources><build><item objectid="1"/></build></model>'
+    )
+    buf = io.BytesIO()
+    with zipfile.ZipFile(buf, "w", zipfile.ZIP_DEFLATED) as zf:
+        zf.writestr("3D/3dmodel.model", model)
+    return buf.getvalue()
+
+_TETRA_3MF = _3mf_minimal()
+
+def prechauffer():
+    try:
+        import trimesh.repair   # noqa: F401 — chargé d'avance pour fix_normals
+        mesurer_mesh(load_mesh(_TETRA_STL, ".stl"))
+        mesurer_mesh(load_mesh(_TETRA_3MF, ".3mf"))
+    except Exception as e:
+        print(f"Préchauffage échoué (ignoré) : {e}")
+
+# ===================== POINT D'ENTRÉE DU POOL =====================
+
+def analyser_mesh(file_bytes, suffix):
+    """Fonction pure exécutée dans le pool : octets du fichier -> StatsMesh."""
+    stats = None
+    if suffix == ".stl":
+        sommets = sommets_stl_binaire(file_bytes)
+        if sommets is not None:
+            stats = mesurer_stl_binaire(sommets)
+    if stats is None:
+        stats = mesurer_mesh(load_mesh(file_bytes, suffix))
+    return stats
+
+def init_processus(nb_processus):
+    # Les processus se partagent les cœurs : sans ça, chacun lancerait un
+    # thread numba par cœur.
+    if numba is not None:
+        numba.set_num_threads(max(1, numba.config.NUMBA_NUM_THREADS // nb_processus))
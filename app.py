@@ -1,18 +1,62 @@
+import os
+
+# Le serveur tourne avec plusieurs threads : on évite que chaque appel NumPy/BLAS
+# lance en plus son propre pool de threads (sur-souscription des cœurs).
+# Doit être fixé avant l'import de numpy.
+os.environ.setdefault("OMP_NUM_THREADS", "1")
+
 from flask import Flask, request, jsonify
+from flask.json.provider import DefaultJSONProvider
 from flask_cors import CORS
-import trimesh
-import numpy as np
-import tempfile
-import os
-import uuid
-import urllib.request
-import urllib.error
-import json as json_lib
-from datetime import datetime
+from werkzeug.exceptions import RequestEntityTooLarge
+try:
+    from flask_compress import Compress
+except ImportError:
+    Compress = None
+    print("flask-compress non installé — réponses JSON non compressées")
+import orjson
+import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+import io
+import hashlib
+import threading
+from collections import OrderedDict, namedtuple
+from dataclasses import asdict
+import multiprocessing
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor, TimeoutError as FutureTimeout
+from concurrent.futures.process import BrokenProcessPool
+
+from analyse import (
+    StatsMesh, ECHANTILLON_STL, sommets_stl_binaire, etendue_stl,
+    analyser_mesh, init_processus, prechauffer,
+)
+
+class OrjsonProvider(DefaultJSONProvider):
+    """jsonify via orjson : sérialisation native, directement en bytes UTF-8."""
+    option = orjson.OPT_SERIALIZE_NUMPY
+
+    def dumps(self, obj, **kwargs):
+        return orjson.dumps(obj, option=self.option).decode()
+
+    def loads(self, s, **kwargs):
+        return orjson.loads(s)
+
+    def response(self, *args, **kwargs):
+        obj = self._prepare_response_obj(args, kwargs)
+        return self._app.response_class(orjson.dumps(obj, option=self.option), mimetype=self.mimetype)
 
 app = Flask(__name__)
+app.json = OrjsonProvider(app)
 CORS(app)
 
+# Réponses JSON > 500 o compressées (gzip/br selon Accept-Encoding)
+app.config["COMPRESS_MIMETYPES"] = ["application/json"]
+app.config["COMPRESS_LEVEL"]     = 6
+app.config["COMPRESS_MIN_SIZE"]  = 500
+if Compress is not None:
+    Compress(app)
+
 @app.after_request
 def after_request(response):
     response.headers.add("Access-Control-Allow-Origin", "*")
@@ -27,55 +71,109 @@ DENSITE = {"PLA": 1.24, "PETG": 1.27, "TPU": 1.20, "ASA": 1.07}
 # Vitesse d'extrusion estimée par matériau (mm³/s) — sert au calcul du temps
 VITESSE_MM3_S = {"PLA": 8.0, "PETG": 6.5, "TPU": 3.5, "ASA": 6.0}
 
+# Les trois tables regroupées : une seule recherche par matériau
+MatCfg    = namedtuple("MatCfg", "densite vitesse prix_kg")
+MATERIAUX = {m: MatCfg(DENSITE[m], VITESSE_MM3_S[m], PRIX_KG[m]) for m in DENSITE}
+
 REMPLISSAGE        = 0.20   # 20% infill
 EPAISSEUR_COQUE    = 0.12
 PRIX_HEURE_MACHINE = 1.50   # €/heure d'impression
 COEFFICIENT_MARGE  = 1.40   # 40% de marge
 PRIX_MIN           = 3.0    # plancher absolu
 
+# Taille maximale d'un fichier envoyé à /analyze, et de ce qu'il contient une
+# fois décompressé (un .3mf est un ZIP : 50 Mo peuvent cacher des Go de XML).
+# Le loader 3MF de trimesh décompresse toutes les entrées de l'archive en
+# mémoire et monte à ~16× la taille du XML : 16 Mo décompressés tiennent en
+# ~260 Mo, ce qu'une analyse peut se permettre sur une instance à 512 Mo.
+MAX_UPLOAD_BYTES    = 50 * 1024 * 1024
+MAX_3MF_DECOMPRESSE = 16 * 1024 * 1024
+MAX_TRIANGLES       = 5_000_000
+FORMATS_ACCEPTES    = frozenset({".stl", ".3mf", ".obj"})
+
 # Plateau Anycubic Kobra MAX
-PLATEAU = {"x": 250.0, "y": 250.0, "z": 250.0}
+PLATEAU     = {"x": 250.0, "y": 250.0, "z": 250.0}
+PLATEAU_MAX = (PLATEAU["x"], PLATEAU["y"], PLATEAU["z"])
+SURFACE_MAX = PLATEAU["x"] * PLATEAU["y"]
+AXES        = ("X", "Y", "Z")
 
 # ===================== CONFIG SHOPIFY =====================
 SHOPIFY_STORE = "tf-b-creations.myshopify.com"
 SHOPIFY_TOKEN = os.environ.get("SHOPIFY_ADMIN_TOKEN", "")
 
+# Session partagée : la connexion TLS vers Shopify est réutilisée d'une commande
+# à l'autre. Les retries ne portent que sur les échecs de connexion (POST n'est
+# pas rejoué une fois envoyé, pour ne pas créer deux brouillons).
+SHOPIFY_SESSION = requests.Session()
+SHOPIFY_SESSION.headers.update({
+    "X-Shopify-Access-Token": SHOPIFY_TOKEN,
+    "Content-Type": "application/json",
+})
+SHOPIFY_SESSION.mount("https://", HTTPAdapter(
+    pool_connections=4,
+    pool_maxsize=4,
+    max_retries=Retry(total=2, backoff_factor=0.3),
+))
+
 # ===================== CONFIG CLOUDFLARE R2 =====================
 R2_ACCOUNT_ID = os.environ.get("R2_ACCOUNT_ID", "")
 R2_ACCESS_KEY = os.environ.get("R2_ACCESS_KEY", "")
 R2_SECRET_KEY = os.environ.get("R2_SECRET_KEY", "")
 R2_BUCKET     = os.environ.get("R2_BUCKET", "tfb-stl-files")
 
+# Les uploads R2 tournent en tâche de fond pendant l'analyse du mesh
+R2_EXECUTOR   = ThreadPoolExecutor(max_workers=4, thread_name_prefix="r2-upload")
+R2_TIMEOUT_S  = 15
+
 def get_r2_client():
     if not all([R2_ACCOUNT_ID, R2_ACCESS_KEY, R2_SECRET_KEY]):
         return None
     try:
         import boto3
+        from botocore.config import Config
         return boto3.client(
             "s3",
             endpoint_url=f"https://{R2_ACCOUNT_ID}.r2.cloudflarestorage.com",
             aws_access_key_id=R2_ACCESS_KEY,
             aws_secret_access_key=R2_SECRET_KEY,
-            region_name="auto"
+            region_name="auto",
+            config=Config(max_pool_connections=20, retries={"max_attempts": 2}),
         )
     except ImportError:
         print("boto3 non installé — upload R2 désactivé")
         return None
 
-def upload_stl_r2(file_bytes, original_filename):
-    client = get_r2_client()
+# Construit une seule fois : créer un client boto3 relit les modèles de service
+# JSON à chaque fois, et le pool garde les connexions TLS vers R2 ouvertes.
+# Les clients boto3 sont utilisables depuis plusieurs threads.
+R2_CLIENT = get_r2_client()
+
+def upload_stl_r2(file_bytes, original_filename, digest):
+    """
+    Envoie le fichier vers R2. upload_fileobj lit le BytesIO par morceaux (8 Mo),
+    qui partage le buffer de file_bytes : aucune copie supplémentaire.
+    La clé dérive du hash du contenu : un fichier déjà présent (même client qui
+    change seulement de matériau/échelle) n'est pas renvoyé.
+    """
+    client = R2_CLIENT
     if not client:
         return None
     try:
-        date_str  = datetime.now().strftime("%Y%m%d")
-        unique_id = str(uuid.uuid4())[:8]
-        key       = f"{date_str}/{unique_id}_{original_filename}"
-        client.put_object(
-            Bucket=R2_BUCKET,
-            Key=key,
-            Body=file_bytes,
-            ContentType="application/octet-stream",
-            Metadata={"original_name": original_filename}
+        key = f"{digest[:2]}/{digest}_{original_filename}"
+        try:
+            client.head_object(Bucket=R2_BUCKET, Key=key)
+            return key
+        except client.exceptions.ClientError:
+            pass   # absent du bucket (404) : on l'envoie
+
+        client.upload_fileobj(
+            io.BytesIO(file_bytes),
+            R2_BUCKET,
+            key,
+            ExtraArgs={
+                "ContentType": "application/octet-stream",
+                "Metadata":    {"original_name": original_filename},
+            },
         )
         return key
     except Exception as e:
@@ -84,155 +182,275 @@ def upload_stl_r2(file_bytes, original_filename):
 
 # ===================== CHARGEMENT MESH =====================
 
-def load_mesh_3mf(tmp_path):
+def verifier_taille_mesh(file_bytes, suffix):
     """
-    Parse un .3mf manuellement (ZIP + XML) sans dépendance externe.
-    Retourne un trimesh.Trimesh construit depuis les vertices/faces extraits.
+    Sonde bon marché avant tout parsing : nombre de triangles annoncé par l'en-tête
+    d'un STL binaire, taille décompressée des .model d'un 3MF.
+    Retourne un message d'erreur, ou None si le fichier est acceptable.
     """
-    import zipfile
-    import xml.etree.ElementTree as ET
-
-    ns = {"m": "http://schemas.microsoft.com/3dmanufacturing/core/2015/02"}
-
-    all_vertices = []
-    all_faces    = []
-    vertex_offset = 0
-
-    with zipfile.ZipFile(tmp_path, "r") as zf:
-        # Cherche tous les fichiers .model dans le ZIP
-        model_files = [n for n in zf.namelist() if n.endswith(".model")]
-        if not model_files:
-            raise ValueError("Aucun fichier .model trouvé dans le .3mf")
-
-        for model_file in model_files:
-            tree = ET.fromstring(zf.read(model_file))
-            for mesh_el in tree.findall(".//m:mesh", ns):
-                verts_el = mesh_el.find("m:vertices", ns)
-                tris_el  = mesh_el.find("m:triangles", ns)
-                if verts_el is None or tris_el is None:
-                    continue
-
-                for v in verts_el.findall("m:vertex", ns):
-                    all_vertices.append([
-                        float(v.get("x", 0)),
-                        float(v.get("y", 0)),
-                        float(v.get("z", 0)),
-                    ])
-
-                for t in tris_el.findall("m:triangle", ns):
-                    all_faces.append([
-                        int(t.get("v1")) + vertex_offset,
-                        int(t.get("v2")) + vertex_offset,
-                        int(t.get("v3")) + vertex_offset,
-                    ])
-
-                vertex_offset += len(verts_el.findall("m:vertex", ns))
-
-    if not all_vertices or not all_faces:
-        raise ValueError("Aucune géométrie valide trouvée dans le .3mf")
-
-    return trimesh.Trimesh(
-        vertices=np.array(all_vertices, dtype=np.float64),
-        faces=np.array(all_faces,    dtype=np.int64),
-        process=True
-    )
+    if suffix == ".stl" and len(file_bytes) >= 84:
+        # Même détection que sommets_stl_binaire (taille exacte 84 + 50 × n) : le
+        # préfixe "solid" se retrouve aussi dans l'en-tête de STL binaires.
+        # Avec MAX_UPLOAD_BYTES à 50 Mo, un STL binaire cohérent plafonne à ~1M
+        # triangles : MAX_TRIANGLES ne sert que si la limite d'upload est relevée.
+        # Un en-tête dont le compte contredit la taille n'est pas lu comme binaire.
+        n_tri = int.from_bytes(file_bytes[80:84], "little")
+        if len(file_bytes) == 84 + 50 * n_tri and n_tri > MAX_TRIANGLES:
+            return f"Mesh trop complexe ({n_tri} triangles, max {MAX_TRIANGLES})"
+    elif suffix == ".3mf":
+        import zipfile
+        try:
+            with zipfile.ZipFile(io.BytesIO(file_bytes), "r") as zf:
+                # Toutes les entrées, pas seulement les .model : trimesh les décompresse toutes
+                taille = sum(i.file_size for i in zf.infolist())
+        except Exception:
+            return None   # archive illisible : le chargement renverra l'erreur habituelle
+        if taille > MAX_3MF_DECOMPRESSE:
+            return f"3MF trop volumineux une fois décompressé (max {MAX_3MF_DECOMPRESSE // (1024 * 1024)} Mo)"
+    return None
+
+# ===================== CACHE MESH =====================
+# Les clients renvoient souvent le même fichier en changeant seulement
+# materiau/echelle : on garde les invariants du mesh (à l'échelle 1) indexés
+# par le hash du contenu, et seul le calcul de prix est refait.
+# Cache local LRU par processus ; avec REDIS_URL, partagé entre les workers.
+
+MESH_CACHE_MAX   = 256
+REDIS_URL        = os.environ.get("REDIS_URL", "")
+REDIS_TTL_S      = 86400
+_mesh_cache      = OrderedDict()
+_mesh_cache_lock = threading.Lock()
+
+def get_redis_client():
+    if not REDIS_URL:
+        return None
+    try:
+        import redis
+        return redis.Redis.from_url(REDIS_URL, socket_timeout=0.5)
+    except ImportError:
+        print("redis non installé — cache mesh local uniquement")
+        return None
 
+REDIS_CLIENT = get_redis_client()
 
-def load_mesh(tmp_path, suffix):
-    """
-    Charge STL, 3MF ou OBJ et retourne un trimesh.Trimesh unique.
-    - .3mf : parser manuel (pas de networkx)
-    - .stl / .obj : trimesh direct avec force='mesh'
-    """
-    if suffix == ".3mf":
-        mesh = load_mesh_3mf(tmp_path)
-    else:
-        loaded = trimesh.load(tmp_path, force='mesh')
-        if isinstance(loaded, trimesh.Trimesh):
-            mesh = loaded
-        elif isinstance(loaded, trimesh.Scene):
-            meshes = [g for g in loaded.geometry.values() if isinstance(g, trimesh.Trimesh)]
-            if not meshes:
-                raise ValueError("Aucune géométrie valide trouvée dans le fichier.")
-            mesh = trimesh.util.concatenate(meshes)
-        else:
-            raise ValueError(f"Format non reconnu : {type(loaded)}")
-
-    if not mesh.is_watertight:
-        trimesh.repair.fix_normals(mesh)
-        trimesh.repair.fill_holes(mesh)
-
-    return mesh
+def hash_contenu(file_bytes):
+    """Empreinte BLAKE2b (16 octets) du fichier."""
+    return hashlib.blake2b(file_bytes, digest_size=16).hexdigest()
+
+def cache_get(digest):
+    with _mesh_cache_lock:
+        stats = _mesh_cache.get(digest)
+        if stats is not None:
+            _mesh_cache.move_to_end(digest)
+            return stats
+
+    if REDIS_CLIENT is None:
+        return None
+    try:
+        brut = REDIS_CLIENT.get(f"tfb:mesh:{digest}")
+    except Exception as e:
+        print(f"Redis indisponible : {e}")
+        return None
+    if brut is None:
+        return None
+
+    # Valeur périmée ou étrangère sous la clé : simple défaut de cache
+    try:
+        champs = orjson.loads(brut)
+        stats  = StatsMesh(champs["volume_mm3"], champs["aire_mm2"], tuple(champs["dims"]), champs["watertight"])
+    except Exception as e:
+        print(f"Entrée Redis illisible ({digest}) : {e}")
+        return None
+    cache_put(digest, stats, partage=False)
+    return stats
+
+def cache_put(digest, stats, partage=True):
+    with _mesh_cache_lock:
+        _mesh_cache[digest] = stats
+        _mesh_cache.move_to_end(digest)
+        while len(_mesh_cache) > MESH_CACHE_MAX:
+            _mesh_cache.popitem(last=False)
+
+    if partage and REDIS_CLIENT is not None:
+        try:
+            REDIS_CLIENT.set(f"tfb:mesh:{digest}", orjson.dumps(asdict(stats)), ex=REDIS_TTL_S)
+        except Exception as e:
+            print(f"Redis indisponible : {e}")
 
 # ===================== CALCUL PRIX =====================
 
-def calculer_prix(mesh, materiau, echelle=1.0):
-    densite  = DENSITE.get(materiau, 1.24)
-    vitesse  = VITESSE_MM3_S.get(materiau, 8.0)
-    prix_kg  = PRIX_KG.get(materiau, 25.0)
-
-    # — Dimensions & vérification plateau —
-    bounds  = mesh.bounds
-    dims_mm = (bounds[1] - bounds[0]) * echelle
-    warnings = []
-    for axe, val, maxi in zip(["X", "Y", "Z"], dims_mm, [PLATEAU["x"], PLATEAU["y"], PLATEAU["z"]]):
-        if val > maxi:
-            warnings.append(f"Dimension {axe} ({val:.0f} mm) dépasse le plateau max ({int(maxi)} mm)")
-
-    # — Volume —
-    volume_mm3     = abs(mesh.volume) * (echelle ** 3)
-    volume_cm3     = volume_mm3 / 1000.0
-    surface_cm2    = (mesh.area * (echelle ** 2)) / 100.0
-    volume_coque   = surface_cm2 * EPAISSEUR_COQUE
-    volume_imprime = (volume_cm3 * REMPLISSAGE) + volume_coque
-
-    # — Poids —
-    poids_g = volume_imprime * densite
-
-    # — Temps d'impression —
-    volume_mat_mm3 = volume_imprime * 1000.0
-    temps_secondes = volume_mat_mm3 / vitesse
-    temps_heures   = temps_secondes / 3600.0
-    temps_label    = f"{int(temps_heures)}h{int((temps_heures % 1) * 60):02d}"
-
-    # — Surface plateau —
-    surface_xy    = dims_mm[0] * dims_mm[1]
-    surface_max   = PLATEAU["x"] * PLATEAU["y"]
-    ratio_plateau = surface_xy / surface_max
-    suppl_plateau = 0.50 if ratio_plateau > 0.60 else 0.0
-
-    # — Coûts —
-    cout_matiere = (poids_g / 1000.0) * prix_kg
-    cout_machine = temps_heures * PRIX_HEURE_MACHINE
-
-    # — Prix final —
-    prix_brut  = (cout_matiere + cout_machine + suppl_plateau) * COEFFICIENT_MARGE
-    prix_final = max(round(prix_brut, 2), PRIX_MIN)
-
-    return {
-        "prix_final_eur":      prix_final,
-        "prix_filament_eur":   round(cout_matiere, 2),
-        "poids_g":             round(poids_g, 1),
-        "volume_cm3":          round(volume_cm3, 2),
-        "volume_imprime_cm3":  round(volume_imprime, 2),
-        "temps_impression":    temps_label,
-        "surface_plateau_pct": round(ratio_plateau * 100, 1),
-        "materiau":            materiau,
-        "dimensions_mm": {
-            "largeur":    round(dims_mm[0], 1),
-            "profondeur": round(dims_mm[1], 1),
-            "hauteur":    round(dims_mm[2], 1),
-        },
-        "warnings": warnings,
-    }
+def avertissements_plateau(dims_mm):
+    # Le message n'est formaté que pour les axes en dépassement (presque jamais)
+    return [
+        f"Dimension {axe} ({val:.0f} mm) dépasse le plateau max ({int(maxi)} mm)"
+        for axe, val, maxi in zip(AXES, dims_mm, PLATEAU_MAX) if val > maxi
+    ]
+
+def _fabriquer_calcul(materiau):
+    """
+    Construit la fonction de prix propre à un matériau. Tout ce qui ne dépend
+    pas du mesh (densité, vitesse, prix/kg, remplissage, coque, plateau) est
+    replié une fois pour toutes en coefficients locaux de la closure.
+    """
+    densite, vitesse, prix_kg = MATERIAUX[materiau]
+
+    k_volume  = REMPLISSAGE / 1000.0                   # mm³ objet   → cm³ imprimés
+    k_coque   = EPAISSEUR_COQUE / 100.0                # mm² surface → cm³ de coque
+    k_temps   = 1000.0 / (vitesse * 3600.0)            # cm³ imprimés → heures
+    k_matiere = densite * prix_kg / 1000.0             # cm³ imprimés → €
+    k_machine = k_temps * PRIX_HEURE_MACHINE           # cm³ imprimés → € machine
+
+    def calcul(volume_mm3, aire_mm2, dims, echelle=1.0):
+        # — Dimensions & vérification plateau —
+        dims_mm  = [d * echelle for d in dims]
+        warnings = avertissements_plateau(dims_mm)
+
+        # — Volume —
+        e2 = echelle * echelle
+        volume_cm3     = volume_mm3 * e2 * echelle / 1000.0
+        volume_imprime = volume_mm3 * e2 * echelle * k_volume + aire_mm2 * e2 * k_coque
+
+        # — Poids & temps d'impression —
+        poids_g      = volume_imprime * densite
+        temps_heures = volume_imprime * k_temps
+        temps_label  = f"{int(temps_heures)}h{int((temps_heures % 1) * 60):02d}"
+
+        # — Surface plateau —
+        ratio_plateau = dims_mm[0] * dims_mm[1] / SURFACE_MAX
+        suppl_plateau = 0.50 if ratio_plateau > 0.60 else 0.0
+
+        # — Coûts & prix final —
+        cout_matiere = volume_imprime * k_matiere
+        prix_brut    = (cout_matiere + volume_imprime * k_machine + suppl_plateau) * COEFFICIENT_MARGE
+        prix_final   = max(round(prix_brut, 2), PRIX_MIN)
+
+        return {
+            "prix_final_eur":      prix_final,
+            "prix_filament_eur":   round(cout_matiere, 2),
+            "poids_g":             round(poids_g, 1),
+            "volume_cm3":          round(volume_cm3, 2),
+            "volume_imprime_cm3":  round(volume_imprime, 2),
+            "temps_impression":    temps_label,
+            "surface_plateau_pct": round(ratio_plateau * 100, 1),
+            "materiau":            materiau,
+            "dimensions_mm": {
+                "largeur":    round(dims_mm[0], 1),
+                "profondeur": round(dims_mm[1], 1),
+                "hauteur":    round(dims_mm[2], 1),
+            },
+            "warnings": warnings,
+        }
+
+    calcul.__name__ = f"calcul_{materiau}"
+    return calcul
+
+# Une fonction spécialisée par matériau, construite au démarrage
+CALCULS = {m: _fabriquer_calcul(m) for m in MATERIAUX}
+
+def calculer_prix(volume_mm3, aire_mm2, dims, materiau, echelle=1.0):
+    calcul = CALCULS.get(materiau, CALCULS["PLA"])
+    return calcul(volume_mm3, aire_mm2, dims, echelle)
+
+# ===================== POOL D'ANALYSE =====================
+# Optionnel (TFB_PROCESSUS=0 par défaut : analyse dans le thread de la requête).
+# Avec TFB_PROCESSUS > 0, le parsing et l'intégration d'un gros mesh tournent
+# dans des processus séparés : le thread du serveur attend sans tenir le GIL.
+# Cache, prix et R2 restent dans le processus web.
+# Coût : chaque processus pèse ~180 Mo et reçoit sa propre copie du fichier
+# (jusqu'à 50 Mo) ; sur une instance à 512 Mo, garder TFB_PROCESSUS=0. Pour un
+# processus par cœur, compter len(os.sched_getaffinity(0)), pas os.cpu_count().
+# "spawn" : pas de fork d'un processus qui a déjà des threads (R2, numba). Les
+# processus réimportent le module principal : lancés via `waitress-serve app:app`,
+# ils n'importent que analyse.py ; via `python app.py`, ils rechargent app.py.
+
+NB_PROCESSUS      = int(os.environ.get("TFB_PROCESSUS", "0"))
+ANALYSE_TIMEOUT_S = 60
+
+def _creer_pool():
+    if NB_PROCESSUS <= 0:
+        return None
+    pool = ProcessPoolExecutor(
+        max_workers=NB_PROCESSUS,
+        mp_context=multiprocessing.get_context("spawn"),
+        initializer=init_processus,
+        initargs=(NB_PROCESSUS,),
+    )
+    # Les processus démarrent tout de suite et préchauffés, pas à la 1re requête
+    for _ in range(NB_PROCESSUS):
+        pool.submit(prechauffer)
+    return pool
+
+POOL       = None
+_pool_lock = threading.Lock()
+
+# app.py rechargé comme __mp_main__ dans un processus du pool : pas de pool
+# imbriqué, et le préchauffage vient déjà du pool lui-même
+if __name__ != "__mp_main__":
+    POOL = _creer_pool()
+    if POOL is None:
+        prechauffer()
+
+def _recycler_pool(pool):
+    """Remplace le pool, puis arrête l'ancien en tuant ses processus."""
+    global POOL
+    with _pool_lock:
+        if POOL is pool:
+            POOL = _creer_pool()
+    # Pas d'API publique pour tuer les processus d'un ProcessPoolExecutor (< 3.14)
+    processus = list((pool._processes or {}).values())
+    pool.shutdown(wait=False, cancel_futures=True)
+    for p in processus:
+        p.terminate()
+
+def analyser_dans_pool(file_bytes, suffix):
+    """
+    Soumet analyser_mesh au pool. Recrée le pool si un processus est mort (OOM),
+    ou si une analyse dépasse ANALYSE_TIMEOUT_S alors qu'elle tourne déjà.
+    """
+    if POOL is None:
+        return analyser_mesh(file_bytes, suffix)
+    pool = POOL
+    try:
+        future = pool.submit(analyser_mesh, file_bytes, suffix)
+        return future.result(timeout=ANALYSE_TIMEOUT_S)
+    except FutureTimeout:
+        # Abandonnée, la tâche resterait en file avec sa copie du fichier et
+        # bloquerait les analyses suivantes derrière elle
+        if not future.cancel():
+            _recycler_pool(pool)
+        raise TimeoutError(f"analyse trop longue (> {ANALYSE_TIMEOUT_S}s)")
+    except BrokenProcessPool:
+        _recycler_pool(pool)
+        raise
 
 # ===================== ROUTES =====================
 
+# Werkzeug refuse (413) tout corps de requête au-delà de cette taille avant de
+# le lire : un upload énorme ne peut plus saturer la RAM de l'instance.
+# La marge couvre les champs du formulaire multipart autour du fichier.
+app.config["MAX_CONTENT_LENGTH"] = MAX_UPLOAD_BYTES + 1024 * 1024
+
+@app.errorhandler(RequestEntityTooLarge)
+def fichier_trop_gros(e):
+    return jsonify({"error": f"Fichier trop volumineux (max {MAX_UPLOAD_BYTES // (1024 * 1024)} Mo)"}), 413
+
 @app.route("/", methods=["GET"])
 def index():
     return jsonify({"status": "ok", "service": "TechFix & Build — STL Analyzer API"})
 
 
+def reponse_hors_plateau(dims_mm):
+    return jsonify({
+        "error":    "Pièce trop grande pour le plateau",
+        "warnings": avertissements_plateau(dims_mm),
+        "dimensions_mm": {
+            "largeur":    round(dims_mm[0], 1),
+            "profondeur": round(dims_mm[1], 1),
+            "hauteur":    round(dims_mm[2], 1),
+        },
+    }), 400
+
+
 @app.route("/analyze", methods=["POST", "OPTIONS"])
 def analyze():
     if request.method == "OPTIONS":
@@ -245,24 +463,59 @@ def analyze():
     materiau = request.form.get("materiau", "PLA").upper()
     echelle  = float(request.form.get("echelle", 1.0))
 
-    if materiau not in DENSITE:
+    if materiau not in MATERIAUX:
         return jsonify({"error": f"Materiau inconnu : {materiau}"}), 400
 
-    suffix = os.path.splitext(f.filename)[1].lower()
-    if suffix not in [".stl", ".3mf", ".obj"]:
+    _, point, ext = f.filename.rpartition(".")
+    suffix = "." + ext.lower()
+    if not point or suffix not in FORMATS_ACCEPTES:
         return jsonify({"error": "Format non supporte. Utilisez .stl, .3mf ou .obj"}), 400
 
+    # Le fichier reste en mémoire (borné par MAX_UPLOAD_BYTES) : trimesh, le
+    # hash et R2 lisent tous le même buffer, sans aller-retour disque.
     file_bytes = f.read()
-    r2_key     = upload_stl_r2(file_bytes, f.filename)
+    if len(file_bytes) > MAX_UPLOAD_BYTES:
+        raise RequestEntityTooLarge()
+
+    erreur_taille = verifier_taille_mesh(file_bytes, suffix)
+    if erreur_taille:
+        return jsonify({"error": erreur_taille}), 413
+
+    # STL binaire : un échantillon de triangles minore l'encombrement. S'il
+    # dépasse déjà le plateau, refus immédiat : ni hash, ni upload R2, ni analyse.
+    sommets = sommets_stl_binaire(file_bytes) if suffix == ".stl" else None
+    if sommets is not None:
+        pas = max(1, len(sommets) // ECHANTILLON_STL)
+        if avertissements_plateau([float(d) * echelle for d in etendue_stl(sommets[::pas])]):
+            return reponse_hors_plateau([float(d) * echelle for d in etendue_stl(sommets)])
+
+    digest = hash_contenu(file_bytes)
 
-    with tempfile.NamedTemporaryFile(delete=False, suffix=suffix) as tmp:
-        tmp.write(file_bytes)
-        tmp_path = tmp.name
+    # L'upload R2 (réseau) se fait en parallèle du parsing du mesh (CPU)
+    r2_future = R2_EXECUTOR.submit(upload_stl_r2, file_bytes, f.filename, digest)
 
     try:
-        mesh   = load_mesh(tmp_path, suffix)
-        result = calculer_prix(mesh, materiau, echelle)
-        result["watertight"] = mesh.is_watertight
+        stats = cache_get(digest)
+        if stats is None:
+            stats = analyser_dans_pool(file_bytes, suffix)
+            cache_put(digest, stats)
+
+        # Même refus pour tous les formats, sur les dimensions exactes : couvre
+        # les STL ASCII/3MF/OBJ, un cache relu à une autre échelle, et le
+        # triangle isolé que l'échantillon du STL binaire n'a pas vu.
+        dims_mm = [d * echelle for d in stats.dims]
+        if avertissements_plateau(dims_mm):
+            return reponse_hors_plateau(dims_mm)
+
+        result = calculer_prix(stats.volume_mm3, stats.aire_mm2, stats.dims, materiau, echelle)
+
+        try:
+            r2_key = r2_future.result(timeout=R2_TIMEOUT_S)
+        except FutureTimeout:
+            print(f"R2 upload trop long (> {R2_TIMEOUT_S}s) — réponse envoyée sans clé")
+            r2_key = None
+
+        result["watertight"] = stats.watertight
         result["r2_key"]     = r2_key
         result["format"]     = suffix.lstrip(".")   # "stl" ou "3mf" — utile pour le frontend
 
@@ -270,8 +523,6 @@ def analyze():
 
     except Exception as e:
         return jsonify({"error": f"Erreur analyse : {str(e)}"}), 500
-    finally:
-        os.unlink(tmp_path)
 
 
 @app.route("/create-order", methods=["POST", "OPTIONS"])
@@ -339,17 +590,13 @@ def create_order():
         }
     }
 
-    url     = f"https://{SHOPIFY_STORE}/admin/api/2024-01/draft_orders.json"
-    headers = {
-        "X-Shopify-Access-Token": SHOPIFY_TOKEN,
-        "Content-Type": "application/json",
-    }
+    url = f"https://{SHOPIFY_STORE}/admin/api/2024-01/draft_orders.json"
 
     try:
-        body = json_lib.dumps(draft_order).encode("utf-8")
-        req  = urllib.request.Request(url, data=body, headers=headers, method="POST")
-        with urllib.request.urlopen(req, timeout=15) as r:
-            resp_data = json_lib.loads(r.read().decode())
+        r = SHOPIFY_SESSION.post(url, data=orjson.dumps(draft_order), timeout=15)
+        if not r.ok:
+            return jsonify({"error": "Erreur Shopify", "details": r.text}), r.status_code
+        resp_data = orjson.loads(r.content)
 
         return jsonify({
             "success":     True,
@@ -357,12 +604,16 @@ def create_order():
             "order_name":  resp_data["draft_order"].get("name", ""),
         })
 
-    except urllib.error.HTTPError as e:
-        return jsonify({"error": "Erreur Shopify", "details": e.read().decode()}), e.code
     except Exception as e:
         return jsonify({"error": f"Erreur reseau : {str(e)}"}), 500
 
 
 if __name__ == "__main__":
     port = int(os.environ.get("PORT", 5000))
-    app.run(host="0.0.0.0", port=port)
+    try:
+        # Serveur WSGI de production ; alternative : gunicorn -w 4 -k gthread --threads 4 app:app
+        from waitress import serve
+        serve(app, host="0.0.0.0", port=port, threads=8)
+    except ImportError:
+        print("waitress non installé — serveur de développement Flask")
+        app.run(host="0.0.0.0", port=port, threaded=True)